@@ -0,0 +1,20 @@
+import pypdfium2 as pdfium
+
+# Extração de texto de PDFs executada nos processos do ProcessPoolExecutor do app.
+# Fica em um módulo próprio porque o processo filho precisa importar a função pelo nome.
+
+# Função para extrair o texto de um PDF (bytes), página a página, com o PDFium (nativo).
+# O PDFium não é thread-safe; cada processo trata um documento por vez.
+def extract_text(pdf_bytes):
+    pdf = pdfium.PdfDocument(pdf_bytes)
+    try:
+        pages = []
+        for page in pdf:
+            textpage = page.get_textpage()
+            pages.append(textpage.get_text_range())
+            textpage.close()
+            page.close()
+    finally:
+        pdf.close()
+    
+    return "\n".join(pages)
@@ -1,12 +1,26 @@
 import streamlit as st
-import tempfile
-import os
+import functools
+import json
+import hashlib
+import logging
+import sqlite3
+from contextlib import closing
+from collections import OrderedDict
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import time
-from openai import OpenAI
+import asyncio
+import threading
+import queue
+import httpx
+from openai import NOT_GIVEN, OpenAI, AsyncOpenAI, RateLimitError, APIConnectionError, InternalServerError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
 from supabase import create_client
-import pypdf
+import pdf_parser
 import uuid
-from langchain_openai import OpenAIEmbeddings
+import numpy as np
+import tiktoken
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 
 # Configuração da página
@@ -16,21 +30,131 @@ st.set_page_config(
     layout="wide"
 )
 
-# Inicialização da API OpenAI
-openai_api_key = st.secrets["OPENAI_API_KEY"]
-client = OpenAI(api_key=openai_api_key)
+# Tempo máximo (segundos) de cada requisição à OpenAI; as novas tentativas ficam com o tenacity
+OPENAI_TIMEOUT = 30
 
-# Inicialização do Supabase
-supabase_url = st.secrets["SUPABASE_URL"]
-supabase_key = st.secrets["SUPABASE_KEY"]
-supabase = create_client(supabase_url, supabase_key)
+# Lotes de embeddings de um upload chegam a ~290 mil tokens: cada tentativa ganha mais tempo
+EMBEDDING_TIMEOUT = 180
 
-# Configuração do OpenAI Embeddings
-embeddings = OpenAIEmbeddings(
-    model="text-embedding-3-small",
-    openai_api_key=openai_api_key
+# Cliente OpenAI reaproveitado entre reruns (mantém o pool de conexões HTTP)
+@st.cache_resource
+def get_openai_client():
+    return OpenAI(
+        api_key=st.secrets["OPENAI_API_KEY"],
+        timeout=OPENAI_TIMEOUT,
+        max_retries=0,
+        http_client=httpx.Client(
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100)
+        )
+    )
+
+# Laço de eventos em segundo plano, compartilhado por todas as chamadas assíncronas
+@st.cache_resource
+def get_event_loop():
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+# Cliente OpenAI assíncrono único, usado apenas dentro do laço compartilhado
+@st.cache_resource
+def get_async_openai_client():
+    return AsyncOpenAI(
+        api_key=st.secrets["OPENAI_API_KEY"],
+        timeout=OPENAI_TIMEOUT,
+        max_retries=0,
+        http_client=httpx.AsyncClient(
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100)
+        )
+    )
+
+# Limite de lotes de embeddings em andamento ao mesmo tempo durante um upload
+EMBEDDING_CONCURRENCY = 5
+
+@st.cache_resource
+def get_embedding_semaphore():
+    return asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+
+# Erros transitórios da OpenAI (limite de taxa, conexão/timeout, 5xx) que merecem nova tentativa
+RETRYABLE_OPENAI_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)
+
+# Novas tentativas com backoff exponencial aleatório (1s a 30s, até 6 tentativas)
+openai_retry = retry(
+    retry=retry_if_exception_type(RETRYABLE_OPENAI_ERRORS),
+    wait=wait_random_exponential(min=1, max=30),
+    stop=stop_after_attempt(6),
+    reraise=True,
 )
 
+# Chamadas à OpenAI com nova tentativa automática
+@openai_retry
+def create_embeddings(texts):
+    return get_openai_client().embeddings.create(
+        input=texts,
+        model=EMBEDDING_MODEL,
+        dimensions=EMBEDDING_DIMENSIONS
+    )
+
+@openai_retry
+def create_chat_completion(**kwargs):
+    return get_openai_client().chat.completions.create(**kwargs)
+
+@openai_retry
+async def create_embeddings_async(texts):
+    async with get_embedding_semaphore():
+        return await get_async_openai_client().with_options(timeout=EMBEDDING_TIMEOUT).embeddings.create(
+            input=texts,
+            model=EMBEDDING_MODEL,
+            dimensions=EMBEDDING_DIMENSIONS
+        )
+
+# Arquivo JSON Lines com o consumo de tokens de cada chamada ao modelo
+USAGE_LOG_PATH = "llm_usage.jsonl"
+
+# Logger de consumo configurado uma única vez (evita handlers duplicados a cada rerun)
+@st.cache_resource
+def get_usage_logger():
+    logger = logging.getLogger("llm_usage")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    handler = logging.FileHandler(USAGE_LOG_PATH, encoding="utf-8")
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    return logger
+
+# Registra tokens e latência de uma chamada, identificando o prompt por um hash curto
+def log_usage(feature, model, messages, usage, started_at):
+    if usage is None:
+        return
+    
+    prompt_text = "\n".join(message["content"] for message in messages)
+    get_usage_logger().info(json.dumps({
+        "ts": time.time(),
+        "feature": feature,
+        "model": model,
+        "prompt_hash": hashlib.md5(prompt_text.encode()).hexdigest()[:8],
+        "prompt_tokens": usage.prompt_tokens,
+        "completion_tokens": usage.completion_tokens,
+        "latency_ms": round((time.perf_counter() - started_at) * 1000),
+    }))
+
+# Mensagem para o usuário quando a chamada falha mesmo após as novas tentativas
+def openai_error_message(error):
+    if isinstance(error, RETRYABLE_OPENAI_ERRORS):
+        return "A OpenAI está sobrecarregada ou indisponível no momento. Tente novamente em instantes."
+    return f"Erro ao processar: {str(error)}"
+
+# Cliente Supabase reaproveitado entre reruns
+@st.cache_resource
+def get_supabase():
+    return create_client(st.secrets["SUPABASE_URL"], st.secrets["SUPABASE_KEY"])
+
+# Modelo de embeddings usado tanto na ingestão quanto nas consultas
+# (os dois lados precisam do mesmo modelo para que os vetores sejam comparáveis)
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+# Dimensões dos embeddings (a coluna funnel_documents.embedding é vector(512))
+EMBEDDING_DIMENSIONS = 512
+
 # Definição do sistema base de prompts
 SYSTEM_PROMPT = """
 Você é o Funnel Mastermind AI, um especialista em funis de vendas, copywriting e marketing digital.
@@ -87,75 +211,341 @@ Público-alvo: {audience}
 Objetivo do e-mail: {objective}
 """
 
+# Processos que extraem o texto dos PDFs: uploads simultâneos são processados em paralelo
+# de verdade (o PDFium não é thread-safe). Usa "fork" porque "spawn"/"forkserver"
+# reexecutariam o script do Streamlit, que é o __main__, em cada processo filho.
+# É uma troca consciente: "fork" a partir do servidor do Streamlit, que tem várias threads,
+# pode herdar um lock travado e deixar o processo filho em deadlock.
+@st.cache_resource
+def get_pdf_executor():
+    return ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context("fork"))
+
 # Função para extrair texto de PDFs
 def extract_text_from_pdf(pdf_file):
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as temp_file:
-        temp_file.write(pdf_file.read())
-        temp_file_path = temp_file.name
-    
+    executor = get_pdf_executor()
     try:
-        # Abre o PDF e extrai o texto
-        reader = pypdf.PdfReader(temp_file_path)
-        text = ""
-        for page in reader.pages:
-            text += page.extract_text() + "\n"
-        
-        return text
-    except Exception as e:
-        st.error(f"Erro ao processar PDF: {str(e)}")
-        return None
-    finally:
-        # Remove o arquivo temporário
-        os.unlink(temp_file_path)
+        return executor.submit(pdf_parser.extract_text, pdf_file.getvalue()).result()
+    except BrokenProcessPool as e:
+        # Um processo filho morreu (PDF malformado, falta de memória) e o pool ficou inutilizável:
+        # descarta o pool para que o próximo upload crie um novo
+        get_pdf_executor.clear()
+        executor.shutdown(wait=False)
+        raise ValueError(
+            "A extração do texto falhou: o PDF pode estar corrompido ou ser grande demais. "
+            "Tente enviar o documento novamente."
+        ) from e
+
+# Divisor de texto reaproveitado entre uploads e reruns
+@st.cache_resource
+def get_text_splitter():
+    return RecursiveCharacterTextSplitter(
+        chunk_size=600,
+        chunk_overlap=100,
+        length_function=len,
+        separators=["\n\n", "\n", " ", ""]
+    )
 
 # Função para dividir texto em chunks
 def split_text(text):
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=200,
-        length_function=len
+    return get_text_splitter().split_text(text)
+
+# Tamanho e quantidade de letras mínimos para um chunk valer um embedding
+MIN_CHUNK_CHARS = 50
+MIN_CHUNK_LETTERS = 20
+
+# Função para identificar chunks com texto de verdade
+def is_informative(chunk):
+    return len(chunk.strip()) >= MIN_CHUNK_CHARS and sum(ch.isalpha() for ch in chunk) > MIN_CHUNK_LETTERS
+
+# Limites de cada requisição de embeddings: quantidade de chunks e tokens (contados com o tiktoken)
+# (a API aceita até 300 mil tokens por requisição)
+EMBEDDING_BATCH_SIZE = 2048
+EMBEDDING_BATCH_MAX_TOKENS = 290_000
+
+# Tokenizador dos modelos de embedding da OpenAI, para contar tokens exatamente
+@st.cache_resource
+def get_token_encoder():
+    return tiktoken.get_encoding("cl100k_base")
+
+# Agrupa entradas (índice, chunk, hash) consecutivas em lotes o mais cheios possível dentro
+# dos dois limites (a API aceita até 300k tokens por requisição). Consome a entrada aos poucos, lote a lote.
+def batch_chunks(entries):
+    encoder = get_token_encoder()
+    batch = []
+    batch_tokens = 0
+    for entry in entries:
+        tokens = len(encoder.encode_ordinary(entry[1]))
+        if batch and (len(batch) == EMBEDDING_BATCH_SIZE or batch_tokens + tokens > EMBEDDING_BATCH_MAX_TOKENS):
+            yield batch
+            batch = []
+            batch_tokens = 0
+        batch.append(entry)
+        batch_tokens += tokens
+    
+    if batch:
+        yield batch
+
+# Função para gerar os embeddings de um lote, na mesma ordem dos chunks.
+# Os vetores são gravados unitários: a busca por produto interno depende disso.
+async def embed_batch(batch):
+    response = await create_embeddings_async(batch)
+    # A resposta traz o índice de cada entrada: reordena para casar com o lote
+    vectors = np.array(
+        [item.embedding for item in sorted(response.data, key=lambda item: item.index)],
+        dtype=np.float32
     )
-    return text_splitter.split_text(text)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors.tolist()
+
+# Hashes consultados por requisição (cada hash ocupa 64 caracteres na URL)
+HASH_LOOKUP_BATCH_SIZE = 100
+
+# Hash do conteúdo de um chunk (o mesmo calculado pela migração no banco)
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
 
-# Função para criar embeddings e armazenar no Supabase
+# Função para descobrir quais hashes já estão gravados no Supabase
+def find_existing_hashes(hashes):
+    existing = set()
+    for start in range(0, len(hashes), HASH_LOOKUP_BATCH_SIZE):
+        result = get_supabase().table("funnel_documents").select("content_hash").in_(
+            "content_hash", hashes[start:start + HASH_LOOKUP_BATCH_SIZE]
+        ).execute()
+        existing.update(item["content_hash"] for item in result.data or [])
+    return existing
+
+# Gera os chunks inéditos como (índice, chunk, hash): ignora os repetidos no próprio
+# documento e os já presentes na base, consultando o Supabase a cada HASH_LOOKUP_BATCH_SIZE chunks
+def iter_new_chunks(chunks):
+    seen = set()
+    for start in range(0, len(chunks), HASH_LOOKUP_BATCH_SIZE):
+        window = [
+            (start + offset, chunk, content_hash(chunk))
+            for offset, chunk in enumerate(chunks[start:start + HASH_LOOKUP_BATCH_SIZE])
+        ]
+        seen |= find_existing_hashes(list({chunk_hash for _, _, chunk_hash in window} - seen))
+        for i, chunk, chunk_hash in window:
+            if chunk_hash not in seen:
+                seen.add(chunk_hash)
+                yield i, chunk, chunk_hash
+
+# Lotes com embeddings em andamento aguardando gravação (contrapressão do pipeline)
+UPLOAD_PIPELINE_DEPTH = 4
+
+# Função para criar embeddings e armazenar no Supabase.
+# Pipeline: esta thread prepara os lotes (hash, deduplicação, agrupamento) e dispara os
+# embeddings, enquanto uma thread de gravação insere os lotes prontos no Supabase.
+# Retorna quantos chunks novos foram gravados (repetidos são ignorados).
 def store_embeddings(chunks, metadata):
-    # Criar tabela se não existir
-    supabase.table("funnel_documents").select("*").limit(1).execute()
-    
-    # Armazenar cada chunk
-    for i, chunk in enumerate(chunks):
-        # Gerar embedding via OpenAI
-        response = client.embeddings.create(
-            input=chunk,
-            model="text-embedding-3-small"
-        )
-        embedding = response.data[0].embedding
+    batches = queue.Queue(maxsize=UPLOAD_PIPELINE_DEPTH)
+    errors = []
+    
+    # Consumidor: grava cada lote, na ordem, assim que seus embeddings ficam prontos
+    def upload_batches():
+        while (item := batches.get()) is not None:
+            batch, future = item
+            if errors:
+                # Já houve falha: só esvazia a fila para o produtor não travar
+                continue
+            try:
+                rows = [
+                    {
+                        "id": str(uuid.uuid4()),
+                        "content": chunk,
+                        "content_hash": chunk_hash,
+                        "embedding": embedding,
+                        "metadata": {**metadata, "chunk_index": i}
+                    }
+                    for (i, chunk, chunk_hash), embedding in zip(batch, future.result())
+                ]
+                # Outro upload pode ter gravado o mesmo trecho nesse meio-tempo: ignora o conflito
+                get_supabase().table("funnel_documents").upsert(
+                    rows, on_conflict="content_hash", ignore_duplicates=True
+                ).execute()
+            except Exception as e:
+                errors.append(e)
+    
+    uploader = threading.Thread(target=upload_batches, daemon=True)
+    uploader.start()
+    
+    # Produtor: dispara os embeddings lote a lote no laço assíncrono compartilhado.
+    # Com a fila cheia, espera a gravação andar antes de preparar o próximo lote.
+    stored = 0
+    try:
+        for batch in batch_chunks(iter_new_chunks(chunks)):
+            if errors:
+                break
+            future = asyncio.run_coroutine_threadsafe(
+                embed_batch([chunk for _, chunk, _ in batch]),
+                get_event_loop()
+            )
+            batches.put((batch, future))
+            stored += len(batch)
+    finally:
+        batches.put(None)
+        uploader.join()
+    
+    if errors:
+        raise errors[0]
+    
+    return stored
+
+# Recuperação: trechos enviados ao modelo, candidatos por método de busca,
+# peso da relevância frente à diversidade no MMR e constante do RRF
+RETRIEVAL_K = 3
+RETRIEVAL_FETCH_K = 15
+MMR_LAMBDA = 0.5
+RRF_K = 60
+
+# Normaliza espaços e maiúsculas para que variações da mesma pergunta compartilhem o embedding
+def normalize_query(query):
+    return " ".join(query.split()).lower()
+
+# Função para gerar o embedding de uma consulta (em cache por texto normalizado)
+@st.cache_data(max_entries=2048, show_spinner=False)
+def embed_query(query):
+    response = create_embeddings(query)
+    return response.data[0].embedding
+
+# Executor que processa os uploads em segundo plano, sem bloquear a interface
+@st.cache_resource
+def get_ingestion_executor():
+    return ThreadPoolExecutor(max_workers=2)
+
+# Função para processar um documento completo: extrai, divide e indexa (roda no executor)
+def process_document(pdf_file, metadata):
+    text = extract_text_from_pdf(pdf_file)
+    if not text:
+        raise ValueError("Não foi possível extrair texto do documento.")
+    
+    # Descarta chunks sem conteúdo útil (sumários, linhas separadoras, páginas em branco)
+    chunks = [chunk for chunk in split_text(text) if is_informative(chunk)]
+    try:
+        return store_embeddings(chunks, metadata)
+    finally:
+        # A base mudou (mesmo que só em parte, se houve falha): descarta os caches de todo o
+        # processo aqui, e não na sessão que enviou o arquivo, que pode já ter sido fechada
+        clear_knowledge_caches()
+
+# Função para descartar os caches que dependem do conteúdo da base
+def clear_knowledge_caches():
+    search_candidates.clear()
+    clear_answers("base")
+    check_documents.clear()
+    list_documents.clear()
+
+# Painel com o andamento dos uploads, atualizado a cada 2 segundos
+@st.fragment(run_every=2)
+def show_ingestion_jobs():
+    jobs = st.session_state.jobs
+    finished = [job_id for job_id, job in jobs.items() if job["future"].done()]
+    
+    for job_id in finished:
+        job = jobs.pop(job_id)
+        try:
+            chunk_count = job["future"].result()
+        except Exception as e:
+            st.session_state.job_messages.append(
+                ("error", f"Erro ao processar documento '{job['title']}': {str(e)}")
+            )
+            continue
+        
+        # A base mudou: descarta as buscas guardadas nesta sessão
+        # (os caches compartilhados já foram limpos por process_document)
+        st.session_state.pop("last_retrieval", None)
+        st.session_state.pop("chunk_pool", None)
         
-        # Preparar metadados completos
-        full_metadata = metadata.copy()
-        full_metadata["chunk_index"] = i
+        # Marca que temos documentos
+        st.session_state.has_documents = True
         
-        # Armazenar no Supabase
-        supabase.table("funnel_documents").insert({
-            "id": str(uuid.uuid4()),
-            "content": chunk,
-            "embedding": embedding,
-            "metadata": full_metadata
-        }).execute()
-    
-    return len(chunks)
-
-# Função para buscar informações relevantes no Supabase
-def search_knowledge_base(query, top_k=5):
-    # Gerar embedding para a consulta
-    response = client.embeddings.create(
-        input=query,
-        model="text-embedding-3-small"
+        st.session_state.job_messages.append(
+            ("success", f"Documento '{job['title']}' processado com sucesso! Foram criados {chunk_count} fragmentos de conhecimento.")
+        )
+    
+    for job in jobs.values():
+        st.info(f"Processando '{job['title']}'... você pode continuar usando o app.")
+    
+    # Recarrega o app inteiro para exibir o resultado e a lista de documentos atualizada
+    if finished:
+        st.rerun()
+
+# Função para buscar informações relevantes no Supabase: candidatos da busca híbrida
+# (em cache até o próximo upload, pois a busca é determinística para a mesma base)
+@st.cache_data(ttl=3600, show_spinner=False)
+def search_candidates(query):
+    # A busca textual roda em paralelo ao embedding + busca vetorial
+    text_future = asyncio.run_coroutine_threadsafe(
+        asyncio.to_thread(search_full_text, query, RETRIEVAL_FETCH_K),
+        get_event_loop()
     )
-    query_embedding = response.data[0].embedding
     
+    # Gerar (ou reaproveitar) o embedding da consulta
+    query_embedding = embed_query(normalize_query(query))
+    vector_results = search_by_embedding(query_embedding, RETRIEVAL_FETCH_K)
+    
+    # Combina os dois rankings
+    return reciprocal_rank_fusion(vector_results, text_future.result())[:RETRIEVAL_FETCH_K]
+
+# Função para buscar documentos por texto (full-text em português) no Supabase
+def search_full_text(query, top_k=RETRIEVAL_FETCH_K):
+    result = get_supabase().rpc(
+        "match_documents_fts",
+        {"query_text": query, "match_count": top_k}
+    ).execute()
+    
+    return [
+        {
+            "id": item["id"],
+            "content": item["content"],
+            "metadata": item["metadata"],
+            "embedding": parse_embedding(item["embedding"]),
+            "rank": item["rank"]
+        }
+        for item in result.data or []
+    ]
+
+# O PostgREST devolve colunas vector como texto ("[0.1,0.2,...]")
+def parse_embedding(value):
+    return json.loads(value) if isinstance(value, str) else value
+
+# Função para combinar rankings via Reciprocal Rank Fusion: score = soma de 1 / (k + posição)
+def reciprocal_rank_fusion(*rankings):
+    scores = {}
+    items = {}
+    for ranking in rankings:
+        for position, item in enumerate(ranking, start=1):
+            scores[item["id"]] = scores.get(item["id"], 0) + 1 / (RRF_K + position)
+            items.setdefault(item["id"], item)
+    
+    return [
+        {**items[doc_id], "score": scores[doc_id]}
+        for doc_id in sorted(scores, key=scores.get, reverse=True)
+    ]
+
+# Função para selecionar trechos por Maximal Marginal Relevance.
+# A relevância é o score do RRF (normalizado) e a redundância é o cosseno com os já escolhidos.
+def max_marginal_relevance(candidates, top_k, lambda_mult):
+    if not candidates:
+        return []
+    
+    vectors = np.array([c["embedding"] for c in candidates], dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    relevance = np.array([c["score"] for c in candidates], dtype=np.float32)
+    relevance /= relevance.max()
+    
+    selected = [0]
+    while len(selected) < min(top_k, len(candidates)):
+        redundancy = (vectors @ vectors[selected].T).max(axis=1)
+        scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        scores[selected] = -np.inf
+        selected.append(int(np.argmax(scores)))
+    
+    return [candidates[i] for i in selected]
+
+# Função para buscar documentos similares a partir de um embedding já calculado
+def search_by_embedding(query_embedding, top_k=RETRIEVAL_FETCH_K):
     # Buscar documentos similares via função match_documents
-    result = supabase.rpc(
+    result = get_supabase().rpc(
         "match_documents", 
         {"query_embedding": query_embedding, "match_count": top_k}
     ).execute()
@@ -167,79 +557,324 @@ def search_knowledge_base(query, top_k=5):
     contexts = []
     for item in result.data:
         contexts.append({
+            "id": item["id"],
             "content": item["content"],
             "metadata": item["metadata"],
+            "embedding": parse_embedding(item["embedding"]),
             "similarity": item["similarity"]
         })
     
     return contexts
 
-# Função para consultar o modelo com base de conhecimento
-def ask_with_knowledge(question):
+# Número máximo de fontes listadas ao fim de cada resposta
+MAX_SOURCES = 3
+
+# Similaridade mínima com a pergunta anterior para reaproveitar os mesmos documentos
+RETRIEVAL_REUSE_THRESHOLD = 0.92
+
+# Similaridade de cosseno entre dois embeddings
+def cosine_similarity(a, b):
+    a = np.asarray(a, dtype=np.float32)
+    b = np.asarray(b, dtype=np.float32)
+    return float(a @ b / (np.linalg.norm(a) * np.linalg.norm(b)))
+
+# Trechos já buscados nesta sessão, reaproveitados para reordenar localmente
+# (com similaridade mínima exigida de cada trecho devolvido sem ir ao Supabase)
+LOCAL_POOL_SIZE = 500
+LOCAL_RERANK_THRESHOLD = 0.6
+
+# Guarda os candidatos buscados no Supabase, descartando os mais antigos (LRU)
+def remember_chunks(contexts):
+    pool = st.session_state.setdefault("chunk_pool", OrderedDict())
+    for context in contexts:
+        pool[context["id"]] = {**context, "embedding": np.asarray(context["embedding"], dtype=np.float32)}
+        pool.move_to_end(context["id"])
+    
+    while len(pool) > LOCAL_POOL_SIZE:
+        pool.popitem(last=False)
+
+# Reordena os trechos da sessão por similaridade com a consulta (um produto matriz-vetor).
+# Só responde se todos os top_k passarem do limite; senão a busca vai ao Supabase.
+def search_local_pool(query_embedding, top_k=RETRIEVAL_K):
+    pool = st.session_state.get("chunk_pool")
+    if not pool or len(pool) < top_k:
+        return None
+    
+    contexts = list(pool.values())
+    matrix = np.stack([context["embedding"] for context in contexts])
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    query = np.asarray(query_embedding, dtype=np.float32)
+    scores = matrix @ (query / np.linalg.norm(query))
+    
+    top = np.argsort(scores)[::-1][:top_k]
+    if scores[top[-1]] <= LOCAL_RERANK_THRESHOLD:
+        return None
+    
+    for i in top:
+        pool.move_to_end(contexts[i]["id"])
+    return [contexts[i] for i in top]
+
+# Função para recuperar contexto no chat, evitando idas ao Supabase em perguntas de acompanhamento
+def retrieve_for_chat(question):
+    query_embedding = embed_query(normalize_query(question))
+    
+    # Pergunta quase igual à anterior: mesmos documentos
+    last = st.session_state.get("last_retrieval")
+    if last and cosine_similarity(query_embedding, last["embedding"]) > RETRIEVAL_REUSE_THRESHOLD:
+        return last["contexts"]
+    
+    # Trechos já buscados nesta sessão respondem bem à pergunta: reordena localmente
+    contexts = search_local_pool(query_embedding)
+    if contexts is None:
+        candidates = search_candidates(question)
+        remember_chunks(candidates)
+        # Escolhe, entre os candidatos, trechos relevantes e pouco redundantes entre si
+        contexts = max_marginal_relevance(candidates, RETRIEVAL_K, MMR_LAMBDA)
+    
+    st.session_state.last_retrieval = {"embedding": query_embedding, "contexts": contexts}
+    return contexts
+
+# Função para consultar o modelo com base de conhecimento (streaming)
+def ask_with_knowledge_stream(question):
     # Buscar informações relevantes
-    contexts = search_knowledge_base(question)
+    contexts = retrieve_for_chat(question)
     
     if not contexts:
         # Se não encontrar nada, use o prompt padrão
-        return ask_gpt(question)
+        yield from ask_gpt_stream(question)
+        return
     
     # Preparar contexto para o prompt
     context_text = "\n\n---\n\n".join([c["content"] for c in contexts])
     
-    # Consultar o modelo com o contexto
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": KNOWLEDGE_PROMPT.format(context=context_text, question=question)},
-        ],
-        temperature=0.7,
+    # Transmite a resposta do modelo com o contexto
+    yield from stream_completion([
+        {"role": "system", "content": KNOWLEDGE_PROMPT.format(context=context_text, question=question)},
+    ], "chat_base")
+    
+    # Adicionar fontes depois da resposta (títulos únicos, na ordem de relevância)
+    sources = list(dict.fromkeys(
+        context["metadata"]["title"] for context in contexts if "title" in context["metadata"]
+    ))[:MAX_SOURCES]
+    
+    if sources:
+        yield "\n\n**Fontes:**\n" + "".join(f"- {source}\n" for source in sources)
+
+# Função para transmitir a resposta do modelo token a token
+def stream_completion(messages, feature="chat", model="gpt-4o", temperature=0.7, max_tokens=NOT_GIVEN):
+    started_at = time.perf_counter()
+    stream = create_chat_completion(
+        model=model,
+        messages=messages,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        stream=True,
+        stream_options={"include_usage": True},
     )
+    usage = None
+    for chunk in stream:
+        # O último chunk não tem choices, só o consumo de tokens
+        if chunk.usage:
+            usage = chunk.usage
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+    log_usage(feature, model, messages, usage, started_at)
+
+# Função para consultar o modelo GPT-4o com streaming
+def ask_gpt_stream(prompt, system_prompt=SYSTEM_PROMPT, feature="chat"):
+    yield from stream_completion([
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": prompt}
+    ], feature)
+
+# Cache de respostas do chat em disco (SQLite): por texto exato e por similaridade semântica
+ANSWER_CACHE_PATH = "answer_cache.sqlite3"
+ANSWER_CACHE_TTL = 24 * 3600
+SEMANTIC_CACHE_THRESHOLD = 0.92
+
+# Cria a tabela do cache uma única vez por processo
+@st.cache_resource
+def init_answer_cache():
+    with closing(sqlite3.connect(ANSWER_CACHE_PATH)) as conn, conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS answers (
+                key TEXT PRIMARY KEY,
+                namespace TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                answer TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+    return ANSWER_CACHE_PATH
+
+# Chave exata: SHA-256 da pergunta normalizada, separada por modo do chat
+def answer_cache_key(namespace, question):
+    return hashlib.sha256(f"{namespace}\n{normalize_query(question)}".encode()).hexdigest()
+
+# Busca uma resposta para exatamente a mesma pergunta (não precisa de embedding)
+def lookup_exact_answer(namespace, question):
+    with closing(sqlite3.connect(init_answer_cache())) as conn:
+        row = conn.execute(
+            "SELECT answer FROM answers WHERE key = ? AND created_at >= ?",
+            (answer_cache_key(namespace, question), time.time() - ANSWER_CACHE_TTL)
+        ).fetchone()
+    return row[0] if row else None
+
+# Busca a resposta da pergunta mais parecida, se a similaridade passar do limite
+def lookup_similar_answer(namespace, query_embedding):
+    query = np.asarray(query_embedding, dtype=np.float32)
     
-    answer = response.choices[0].message.content
+    # Só compara com vetores da mesma dimensão (float32 = 4 bytes por dimensão)
+    with closing(sqlite3.connect(init_answer_cache())) as conn:
+        rows = conn.execute(
+            "SELECT embedding, answer FROM answers WHERE namespace = ? AND created_at >= ? AND length(embedding) = ?",
+            (namespace, time.time() - ANSWER_CACHE_TTL, query.nbytes)
+        ).fetchall()
     
-    # Adicionar fontes
-    sources = []
-    for context in contexts:
-        if "title" in context["metadata"]:
-            source = context["metadata"]["title"]
-            if source not in sources:
-                sources.append(source)
+    if not rows:
+        return None
     
-    if sources:
-        answer += "\n\n**Fontes:**\n"
-        for source in sources:
-            answer += f"- {source}\n"
+    # Embeddings gravados já normalizados: o produto escalar é o cosseno
+    matrix = np.frombuffer(b"".join(row[0] for row in rows), dtype=np.float32).reshape(len(rows), -1)
+    scores = matrix @ (query / np.linalg.norm(query))
+    best = int(np.argmax(scores))
+    return rows[best][1] if scores[best] > SEMANTIC_CACHE_THRESHOLD else None
+
+# Grava uma resposta no cache e descarta as expiradas
+def store_answer(namespace, question, query_embedding, answer):
+    vector = np.asarray(query_embedding, dtype=np.float32)
+    vector /= np.linalg.norm(vector)
+    with closing(sqlite3.connect(init_answer_cache())) as conn, conn:
+        conn.execute("DELETE FROM answers WHERE created_at < ?", (time.time() - ANSWER_CACHE_TTL,))
+        conn.execute(
+            "INSERT OR REPLACE INTO answers (key, namespace, embedding, answer, created_at) VALUES (?, ?, ?, ?, ?)",
+            (answer_cache_key(namespace, question), namespace, vector.tobytes(), answer, time.time())
+        )
+
+# Descarta as respostas de um modo do chat (ex.: a base de conhecimento mudou)
+def clear_answers(namespace):
+    with closing(sqlite3.connect(init_answer_cache())) as conn, conn:
+        conn.execute("DELETE FROM answers WHERE namespace = ?", (namespace,))
+
+# Função que responde no chat, consultando antes o cache de respostas
+def chat_answer_stream(question, use_knowledge):
+    namespace = "base" if use_knowledge else "geral"
+    try:
+        cached = lookup_exact_answer(namespace, question)
+        if cached is None:
+            cached = lookup_similar_answer(namespace, embed_query(normalize_query(question)))
+        if cached is not None:
+            yield cached
+            return
+        
+        parts = []
+        answer_stream = ask_with_knowledge_stream(question) if use_knowledge else ask_gpt_stream(question)
+        for part in answer_stream:
+            parts.append(part)
+            yield part
+        
+    except Exception as e:
+        yield openai_error_message(e)
+        return
     
-    return answer
+    # Só respostas completas (sem erro) entram no cache. A resposta já foi entregue:
+    # uma falha aqui (ex.: SQLite travado por outra sessão) só é registrada no log
+    try:
+        store_answer(namespace, question, embed_query(normalize_query(question)), "".join(parts))
+    except Exception:
+        logging.getLogger(__name__).warning("Falha ao gravar a resposta no cache", exc_info=True)
+
+# Respostas completas reaproveitadas para prompts idênticos (entre reruns e sessões)
+COMPLETION_CACHE_TTL = 3600
+COMPLETION_CACHE_MAX_ENTRIES = 256
 
-# Função para consultar o modelo GPT-4o
-def ask_gpt(prompt, system_prompt=SYSTEM_PROMPT):
+@st.cache_resource
+def get_completion_cache():
+    return {}
+
+# Função para consultar o modelo com streaming (GPT-4o por padrão).
+# Prompts idênticos da última hora são respondidos do cache; erros não são cacheados.
+def ask_gpt(prompt, system_prompt=SYSTEM_PROMPT, model="gpt-4o", max_tokens=800, temperature=0.3, feature="geral"):
+    cache = get_completion_cache()
+    key = hashlib.sha256(
+        json.dumps([prompt, system_prompt, model, max_tokens, temperature]).encode()
+    ).hexdigest()
+    
+    cached = cache.get(key)
+    if cached and time.time() - cached["created_at"] < COMPLETION_CACHE_TTL:
+        yield cached["answer"]
+        return
+    
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
+        parts = []
+        for part in stream_completion(
+            [
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": prompt}
             ],
-            temperature=0.7,
-        )
-        return response.choices[0].message.content
+            feature,
+            model=model,
+            temperature=temperature,
+            max_tokens=max_tokens
+        ):
+            parts.append(part)
+            yield part
     except Exception as e:
-        return f"Erro ao processar: {str(e)}"
+        yield openai_error_message(e)
+        return
+    
+    # Descarta a entrada mais antiga quando o cache enche
+    if len(cache) >= COMPLETION_CACHE_MAX_ENTRIES:
+        cache.pop(next(iter(cache)), None)
+    cache[key] = {"answer": "".join(parts), "created_at": time.time()}
 
 # Função para analisar funis
 def analyze_funnel(description):
     full_prompt = FUNNEL_ANALYSIS_PROMPT + description
-    return ask_gpt(full_prompt)
+    # Análise: respostas objetivas e mais determinísticas
+    return ask_gpt(full_prompt, model="gpt-4o-mini", max_tokens=800, temperature=0.2, feature="analise_funil")
 
-# Função para criar e-mails
-def create_email(offer, audience, objective):
-    prompt = EMAIL_F4_PROMPT.format(
+# Função para montar o prompt de e-mail (envios idênticos reaproveitam o texto já montado)
+@functools.lru_cache(maxsize=128)
+def render_email_prompt(offer, audience, objective):
+    return EMAIL_F4_PROMPT.format(
         offer=offer,
         audience=audience,
         objective=objective
     )
-    return ask_gpt(prompt)
+
+# Função para criar e-mails
+def create_email(offer, audience, objective):
+    # E-mail: texto curto, com mais variação criativa
+    return ask_gpt(
+        render_email_prompt(offer, audience, objective),
+        model="gpt-4o-mini",
+        max_tokens=600,
+        temperature=0.8,
+        feature="email"
+    )
+
+# Lista os documentos da base, um por título (deduplicados no banco; em cache por 1 minuto)
+@st.cache_data(ttl=60, show_spinner=False)
+def list_documents():
+    result = get_supabase().rpc("list_documents").execute()
+    return {item["title"]: item["metadata"] for item in result.data or []}
+
+# Verifica se existem documentos (erros não são cacheados: a exceção sai da função)
+@st.cache_data(ttl=300, show_spinner=False)
+def check_documents():
+    result = get_supabase().table("funnel_documents").select("id").limit(1).execute()
+    return len(result.data) > 0
+
+# Atualiza o estado da sessão antes de montar as abas, para o chat já saber se há base
+if "has_documents" not in st.session_state:
+    try:
+        st.session_state.has_documents = check_documents()
+    except Exception:
+        st.session_state.has_documents = False
+
+# Quantidade máxima de mensagens do chat re-renderizadas a cada rerun
+CHAT_DISPLAY_LIMIT = 40
 
 # Cabeçalho
 st.title("🧠 Funnel Mastermind AI")
@@ -260,6 +895,17 @@ with tab1:
     # Inicializa histórico de chat se não existir
     if "messages" not in st.session_state:
         st.session_state.messages = []
+    if "history_full" not in st.session_state:
+        st.session_state.history_full = []
+    
+    # Mantém só as últimas mensagens na tela; as mais antigas vão para o histórico completo
+    overflow = len(st.session_state.messages) - CHAT_DISPLAY_LIMIT
+    if overflow > 0:
+        st.session_state.history_full.extend(st.session_state.messages[:overflow])
+        del st.session_state.messages[:overflow]
+    
+    if st.session_state.history_full:
+        st.caption(f"{len(st.session_state.history_full)} mensagens anteriores ocultas.")
     
     # Exibe histórico de mensagens
     for message in st.session_state.messages:
@@ -275,19 +921,10 @@ with tab1:
         with st.chat_message("user"):
             st.markdown(prompt)
         
-        # Exibe indicador de "pensando"
+        # Exibe a resposta da OpenAI à medida que é gerada
         with st.chat_message("assistant"):
-            message_placeholder = st.empty()
-            message_placeholder.markdown("Pensando...")
-            
-            # Obtém resposta da OpenAI
-            if "has_documents" in st.session_state and st.session_state.has_documents:
-                response = ask_with_knowledge(prompt)
-            else:
-                response = ask_gpt(prompt)
-            
-            # Atualiza placeholder com resposta
-            message_placeholder.markdown(response)
+            use_knowledge = "has_documents" in st.session_state and st.session_state.has_documents
+            response = st.write_stream(chat_answer_stream(prompt, use_knowledge))
             
             # Adiciona resposta ao histórico
             st.session_state.messages.append({"role": "assistant", "content": response})
@@ -296,6 +933,12 @@ with tab1:
 with tab2:
     st.header("Adicione documentos à base de conhecimento")
     
+    # Inicializa a fila de uploads em processamento
+    if "jobs" not in st.session_state:
+        st.session_state.jobs = {}
+    if "job_messages" not in st.session_state:
+        st.session_state.job_messages = []
+    
     with st.form("upload_form", clear_on_submit=True):
         uploaded_file = st.file_uploader("Selecione um arquivo PDF", type=["pdf"])
         title = st.text_input("Título do documento", placeholder="Ex: Expert Secrets - Russell Brunson")
@@ -305,69 +948,49 @@ with tab2:
         submit_button = st.form_submit_button("Fazer Upload")
         
         if submit_button and uploaded_file is not None:
-            with st.spinner("Processando documento..."):
-                try:
-                    # Extrai texto do PDF
-                    text = extract_text_from_pdf(uploaded_file)
-                    
-                    if text:
-                        # Divide em chunks
-                        chunks = split_text(text)
-                        
-                        # Prepara metadados
-                        metadata = {
-                            "title": title,
-                            "filename": uploaded_file.name
-                        }
-                        
-                        if author:
-                            metadata["author"] = author
-                        
-                        if category:
-                            metadata["category"] = category
-                        
-                        # Armazena no Supabase
-                        chunk_count = store_embeddings(chunks, metadata)
-                        
-                        # Marca que temos documentos
-                        st.session_state.has_documents = True
-                        
-                        st.success(f"Documento '{title}' processado com sucesso! Foram criados {chunk_count} fragmentos de conhecimento.")
-                    else:
-                        st.error("Não foi possível extrair texto do documento.")
-                
-                except Exception as e:
-                    st.error(f"Erro ao processar documento: {str(e)}")
+            # Prepara metadados
+            metadata = {
+                "title": title,
+                "filename": uploaded_file.name
+            }
+            
+            if author:
+                metadata["author"] = author
+            
+            if category:
+                metadata["category"] = category
+            
+            # Envia o documento para processamento em segundo plano
+            future = get_ingestion_executor().submit(process_document, uploaded_file, metadata)
+            st.session_state.jobs[str(uuid.uuid4())] = {"title": title, "future": future}
+    
+    # Resultados dos uploads concluídos desde a última execução
+    for level, message in st.session_state.job_messages:
+        getattr(st, level)(message)
+    st.session_state.job_messages = []
+    
+    # O painel só é montado (e atualizado a cada 2 segundos) enquanto houver uploads em andamento
+    if st.session_state.jobs:
+        show_ingestion_jobs()
     
     # Exibe documentos na base de conhecimento
     st.subheader("Documentos na base de conhecimento")
     
     try:
-        result = supabase.table("funnel_documents").select("metadata").execute()
+        documents = list_documents()
         
-        if result.data:
-            # Organiza documentos únicos por título
-            documents = {}
-            for item in result.data:
-                if "metadata" in item and "title" in item["metadata"]:
-                    title = item["metadata"]["title"]
-                    if title not in documents:
-                        documents[title] = item["metadata"]
-            
-            # Exibe lista de documentos
-            if documents:
-                st.write(f"Total de documentos: {len(documents)}")
-                for title, metadata in documents.items():
-                    author = metadata.get("author", "")
-                    category = metadata.get("category", "")
-                    info = f"**{title}**"
-                    if author:
-                        info += f" | Autor: {author}"
-                    if category:
-                        info += f" | Categoria: {category}"
-                    st.markdown(info)
-            else:
-                st.info("Nenhum documento encontrado na base de conhecimento.")
+        # Exibe lista de documentos
+        if documents:
+            st.write(f"Total de documentos: {len(documents)}")
+            for title, metadata in documents.items():
+                author = metadata.get("author", "")
+                category = metadata.get("category", "")
+                info = f"**{title}**"
+                if author:
+                    info += f" | Autor: {author}"
+                if category:
+                    info += f" | Categoria: {category}"
+                st.markdown(info)
         else:
             st.info("Nenhum documento encontrado na base de conhecimento.")
     
@@ -386,9 +1009,7 @@ with tab3:
     
     if st.button("Analisar Funil"):
         if description:
-            with st.spinner("Analisando seu funil..."):
-                result = analyze_funnel(description)
-                st.markdown(result)
+            st.write_stream(analyze_funnel(description))
         else:
             st.warning("Por favor, forneça uma descrição do funil para análise.")
 
@@ -402,35 +1023,21 @@ with tab4:
         objective = st.text_input("Objetivo do e-mail", placeholder="Ex: Convidar para um webinar gratuito")
         
         submit_email = st.form_submit_button("Criar E-mail")
-        
-        if submit_email:
-            if offer and audience and objective:
-                with st.spinner("Criando seu e-mail..."):
-                    result = create_email(offer, audience, objective)
-                    st.markdown(result)
-                    
-                    # Adiciona botão para copiar
-                    st.download_button(
-                        label="Baixar E-mail",
-                        data=result,
-                        file_name="email_f4.txt",
-                        mime="text/plain"
-                    )
-            else:
-                st.warning("Por favor, preencha todos os campos.")
-
-# Verifica se existem documentos
-@st.cache_data(ttl=300)
-def check_documents():
-    try:
-        result = supabase.table("funnel_documents").select("id").limit(1).execute()
-        return len(result.data) > 0
-    except:
-        return False
-
-# Atualiza o estado da sessão
-if "has_documents" not in st.session_state:
-    st.session_state.has_documents = check_documents()
+    
+    # O resultado fica fora do formulário: st.download_button não pode ser usado dentro de st.form
+    if submit_email:
+        if offer and audience and objective:
+            result = st.write_stream(create_email(offer, audience, objective))
+            
+            # Adiciona botão para copiar
+            st.download_button(
+                label="Baixar E-mail",
+                data=result,
+                file_name="email_f4.txt",
+                mime="text/plain"
+            )
+        else:
+            st.warning("Por favor, preencha todos os campos.")
 
 # Rodapé
 st.markdown("---")
@@ -0,0 +1,35 @@
+-- Índice ANN (HNSW) para a busca vetorial em funnel_documents.
+-- Sem ele, match_documents faz uma varredura sequencial em todos os embeddings.
+
+create extension if not exists vector;
+
+create index if not exists funnel_documents_embedding_hnsw_idx
+    on funnel_documents
+    using hnsw (embedding vector_cosine_ops)
+    with (m = 16, ef_construction = 64);
+
+-- A ordenação precisa usar o mesmo operador do índice (<=>) para que o HNSW seja usado.
+create or replace function match_documents (
+    query_embedding vector(1536),
+    match_count int default 5
+) returns table (
+    id uuid,
+    content text,
+    metadata jsonb,
+    similarity float
+)
+language plpgsql
+set hnsw.ef_search = 40
+as $$
+begin
+    return query
+    select
+        funnel_documents.id,
+        funnel_documents.content,
+        funnel_documents.metadata,
+        1 - (funnel_documents.embedding <=> query_embedding) as similarity
+    from funnel_documents
+    order by funnel_documents.embedding <=> query_embedding
+    limit match_count;
+end;
+$$;
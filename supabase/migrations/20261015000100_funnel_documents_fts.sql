@@ -0,0 +1,42 @@
+-- Busca textual (full-text) em português para a recuperação híbrida.
+-- Complementa a busca vetorial em termos exatos ("framework F4", nomes de autores).
+
+alter table funnel_documents
+    add column if not exists tsv tsvector
+    generated always as (to_tsvector('portuguese', content)) stored;
+
+create index if not exists funnel_documents_tsv_idx
+    on funnel_documents
+    using gin (tsv);
+
+-- Os termos da pergunta são combinados com OU: perguntas em linguagem natural
+-- raramente contêm todas as palavras de um mesmo trecho.
+create or replace function match_documents_fts (
+    query_text text,
+    match_count int default 5
+) returns table (
+    id uuid,
+    content text,
+    metadata jsonb,
+    rank float
+)
+language plpgsql
+as $$
+declare
+    query tsquery := to_tsquery(
+        'portuguese',
+        replace(plainto_tsquery('portuguese', query_text)::text, '&', '|')
+    );
+begin
+    return query
+    select
+        funnel_documents.id,
+        funnel_documents.content,
+        funnel_documents.metadata,
+        ts_rank_cd(funnel_documents.tsv, query)::float as rank
+    from funnel_documents
+    where funnel_documents.tsv @@ query
+    order by rank desc
+    limit match_count;
+end;
+$$;
@@ -0,0 +1,65 @@
+-- As funções de busca passam a devolver o embedding de cada trecho,
+-- usado no app para a seleção por MMR (diversidade) entre os candidatos.
+-- O tipo de retorno muda, então as funções precisam ser recriadas.
+
+drop function if exists match_documents(vector, int);
+drop function if exists match_documents_fts(text, int);
+
+create function match_documents (
+    query_embedding vector(1536),
+    match_count int default 15
+) returns table (
+    id uuid,
+    content text,
+    metadata jsonb,
+    embedding vector(1536),
+    similarity float
+)
+language plpgsql
+set hnsw.ef_search = 40
+as $$
+begin
+    return query
+    select
+        funnel_documents.id,
+        funnel_documents.content,
+        funnel_documents.metadata,
+        funnel_documents.embedding,
+        1 - (funnel_documents.embedding <=> query_embedding) as similarity
+    from funnel_documents
+    order by funnel_documents.embedding <=> query_embedding
+    limit match_count;
+end;
+$$;
+
+create function match_documents_fts (
+    query_text text,
+    match_count int default 15
+) returns table (
+    id uuid,
+    content text,
+    metadata jsonb,
+    embedding vector(1536),
+    rank float
+)
+language plpgsql
+as $$
+declare
+    query tsquery := to_tsquery(
+        'portuguese',
+        replace(plainto_tsquery('portuguese', query_text)::text, '&', '|')
+    );
+begin
+    return query
+    select
+        funnel_documents.id,
+        funnel_documents.content,
+        funnel_documents.metadata,
+        funnel_documents.embedding,
+        ts_rank_cd(funnel_documents.tsv, query)::float as rank
+    from funnel_documents
+    where funnel_documents.tsv @@ query
+    order by rank desc
+    limit match_count;
+end;
+$$;
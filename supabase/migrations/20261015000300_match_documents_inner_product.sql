@@ -0,0 +1,39 @@
+-- Busca vetorial por produto interno.
+-- Os embeddings são unitários (a OpenAI já os devolve normalizados e o app normaliza
+-- de novo na ingestão), então ordenar por produto interno equivale a ordenar por
+-- cosseno, sem calcular normas a cada comparação.
+
+create index if not exists funnel_documents_embedding_hnsw_ip_idx
+    on funnel_documents
+    using hnsw (embedding vector_ip_ops)
+    with (m = 16, ef_construction = 64);
+
+drop index if exists funnel_documents_embedding_hnsw_idx;
+
+-- <#> devolve o produto interno negativo: quanto menor, mais similar.
+create or replace function match_documents (
+    query_embedding vector(1536),
+    match_count int default 15
+) returns table (
+    id uuid,
+    content text,
+    metadata jsonb,
+    embedding vector(1536),
+    similarity float
+)
+language plpgsql
+set hnsw.ef_search = 40
+as $$
+begin
+    return query
+    select
+        funnel_documents.id,
+        funnel_documents.content,
+        funnel_documents.metadata,
+        funnel_documents.embedding,
+        -(funnel_documents.embedding <#> query_embedding) as similarity
+    from funnel_documents
+    order by funnel_documents.embedding <#> query_embedding
+    limit match_count;
+end;
+$$;
@@ -0,0 +1,76 @@
+-- Embeddings de 1536 para 512 dimensões (parâmetro dimensions do text-embedding-3-small).
+-- Os modelos text-embedding-3 permitem encurtar um vetor existente: basta manter as
+-- primeiras dimensões e normalizar de novo. Assim a base atual é convertida sem re-embedding.
+-- Requer pgvector >= 0.7 (subvector e l2_normalize).
+
+drop function if exists match_documents(vector, int);
+drop function if exists match_documents_fts(text, int);
+drop index if exists funnel_documents_embedding_hnsw_ip_idx;
+
+alter table funnel_documents
+    alter column embedding type vector(512)
+    using l2_normalize(subvector(embedding, 1, 512))::vector(512);
+
+create index funnel_documents_embedding_hnsw_ip_idx
+    on funnel_documents
+    using hnsw (embedding vector_ip_ops)
+    with (m = 16, ef_construction = 64);
+
+create function match_documents (
+    query_embedding vector(512),
+    match_count int default 15
+) returns table (
+    id uuid,
+    content text,
+    metadata jsonb,
+    embedding vector(512),
+    similarity float
+)
+language plpgsql
+set hnsw.ef_search = 40
+as $$
+begin
+    return query
+    select
+        funnel_documents.id,
+        funnel_documents.content,
+        funnel_documents.metadata,
+        funnel_documents.embedding,
+        -(funnel_documents.embedding <#> query_embedding) as similarity
+    from funnel_documents
+    order by funnel_documents.embedding <#> query_embedding
+    limit match_count;
+end;
+$$;
+
+create function match_documents_fts (
+    query_text text,
+    match_count int default 15
+) returns table (
+    id uuid,
+    content text,
+    metadata jsonb,
+    embedding vector(512),
+    rank float
+)
+language plpgsql
+as $$
+declare
+    query tsquery := to_tsquery(
+        'portuguese',
+        replace(plainto_tsquery('portuguese', query_text)::text, '&', '|')
+    );
+begin
+    return query
+    select
+        funnel_documents.id,
+        funnel_documents.content,
+        funnel_documents.metadata,
+        funnel_documents.embedding,
+        ts_rank_cd(funnel_documents.tsv, query)::float as rank
+    from funnel_documents
+    where funnel_documents.tsv @@ query
+    order by rank desc
+    limit match_count;
+end;
+$$;
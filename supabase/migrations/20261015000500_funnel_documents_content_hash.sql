@@ -0,0 +1,20 @@
+-- Hash SHA-256 do conteúdo de cada trecho, usado para não embedar nem gravar
+-- trechos repetidos (cabeçalhos, rodapés, páginas duplicadas).
+
+alter table funnel_documents
+    add column if not exists content_hash text;
+
+-- Preenche os trechos já existentes com o mesmo hash que o app calcula
+-- (SHA-256 em hexadecimal do texto em UTF-8).
+update funnel_documents
+    set content_hash = encode(sha256(convert_to(content, 'UTF8')), 'hex')
+    where content_hash is null;
+
+-- Remove duplicatas já gravadas, mantendo um trecho por hash.
+delete from funnel_documents a
+    using funnel_documents b
+    where a.content_hash = b.content_hash
+      and a.ctid > b.ctid;
+
+create unique index if not exists funnel_documents_content_hash_idx
+    on funnel_documents (content_hash);
@@ -0,0 +1,21 @@
+-- Lista de documentos (um por título) calculada no banco, em vez de o app baixar
+-- os metadados de todos os trechos e deduplicar em Python.
+
+create index if not exists funnel_documents_title_idx
+    on funnel_documents ((metadata->>'title'));
+
+create or replace function list_documents()
+returns table (
+    title text,
+    metadata jsonb
+)
+language sql
+stable
+as $$
+    select distinct on (funnel_documents.metadata->>'title')
+        funnel_documents.metadata->>'title' as title,
+        funnel_documents.metadata
+    from funnel_documents
+    where funnel_documents.metadata ? 'title'
+    order by funnel_documents.metadata->>'title';
+$$;